@@ -2,7 +2,12 @@
 import streamlit as st
 import pandas as pd
 import plotly.express as px
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from sqlalchemy import create_engine
+import json
 import os
 
 hide_streamlit_style = """
@@ -109,6 +114,10 @@ PERSONAGENS = {
 }
 
 
+# Tipo Arrow da coluna de upgrades (lista compacta de índices int16)
+UPGRADES_TYPE = pa.list_(pa.int16())
+
+
 @st.cache_data(ttl=300)
 def load_data():
     query = """
@@ -139,7 +148,11 @@ def load_data():
         lambda x: len(x) if isinstance(x, list) else 0
     )
     df["total_damage"] = df["characters_damage_data"].apply(
-        lambda x: sum(item.get("damage", 0) for item in x) if isinstance(x, list) else 0
+        lambda x: (
+            sum(item.get("damage", 0) for item in x if isinstance(item, dict))
+            if isinstance(x, list)
+            else 0
+        )
     )
     df["relic_count"] = df["relics_id"].apply(
         lambda x: len(x) if isinstance(x, list) else 0
@@ -147,14 +160,27 @@ def load_data():
     df["rewards_count"] = df["selected_rewards"].apply(
         lambda x: len(x) if isinstance(x, list) else 0
     )
-    df["difficulty"] = df["difficulty"].astype(str)
+    dificuldade = df["difficulty"]
+    if (
+        pd.api.types.is_float_dtype(dificuldade)
+        and (dificuldade.dropna() % 1 == 0).all()
+    ):
+        # NULL no banco transforma a coluna inteira em float: 1.0 -> "1"
+        dificuldade = dificuldade.astype("Int64")
+    # Nulos continuam nulos para a validação pegar
+    df["difficulty"] = dificuldade.astype(str).where(dificuldade.notna())
     df["start_time_dt"] = pd.to_datetime(df["start_time"], errors="coerce")
 
     char_rows = []
-    for _, row in df.iterrows():
+    upgrades = []
+    linhas = []
+    for linha, row in df.iterrows():
         chars = row["characters_damage_data"]
         if isinstance(chars, list):
             for idx, char in enumerate(chars):
+                if not isinstance(char, dict):
+                    char = {}
+                upgs = char.get("upgrade_indexes") or []
                 char_rows.append(
                     {
                         "partida_id": row["id"],
@@ -167,15 +193,560 @@ def load_data():
                         "multiplayer": row["multiplayer"],
                         "character_id": char.get("character"),
                         "is_main": idx == 0,
-                        "damage": char.get("damage", 0),
-                        "damage_boss": char.get("damage_boss", 0),
-                        "dps": char.get("dps", 0),
-                        "upgrade_count": len(char.get("upgrade_indexes", [])),
+                        # Sem default: chave ausente vira NaN e cai na validação
+                        "damage": char.get("damage"),
+                        "damage_boss": char.get("damage_boss"),
+                        "dps": char.get("dps"),
                     }
                 )
+                upgrades.append(upgs if isinstance(upgs, list) else None)
+                linhas.append(linha)
     df_chars = pd.DataFrame(char_rows)
+    upgrades_arr, upgrades_validos = validar_upgrades(upgrades)
+    df_chars["upgrades_validos"] = upgrades_validos
+
+    # Validação: partidas com problemas vão para a quarentena
+    partidas_ok, chars_ok, quarentena = validar_partidas(df, df_chars, linhas)
+    df = df[partidas_ok].astype({"win": bool, "multiplayer": bool})
+    df_chars = df_chars[chars_ok].drop(columns="upgrades_validos")
+    if not df_chars.empty:
+        # Após a validação todo ID restante é inteiro
+        df_chars["character_id"] = pd.to_numeric(df_chars["character_id"]).astype(
+            "Int64"
+        )
+        df_chars = df_chars.astype({"win": bool, "multiplayer": bool})
+
+    # Upgrades ficam numa coluna de listas Arrow (offsets + valores int16)
+    # em vez de listas Python, para as análises rodarem vetorizadas
+    upgrades_arr = upgrades_arr.filter(pa.array(chars_ok)).cast(UPGRADES_TYPE)
+    df_chars["upgrade_indexes"] = pd.Series(
+        upgrades_arr, dtype=pd.ArrowDtype(UPGRADES_TYPE), index=df_chars.index
+    )
+    df_chars["upgrade_count"] = pc.list_value_length(upgrades_arr).to_numpy(
+        zero_copy_only=False
+    )
+
+    hist_waves = histograma_incremental(df, df_chars)
+
+    return df, df_chars, hist_waves, quarentena
+
+
+# ==========================
+# VALIDAÇÃO DOS DADOS
+# ==========================
+REGRAS_VALIDACAO = {
+    "id_duplicado": "ID de partida repetido",
+    "sem_personagens": "Sem dados de personagens",
+    "tempo_invalido": "total_seconds ausente ou <= 0",
+    "wave_invalida": "Wave ausente ou negativa",
+    "win_invalido": "win ausente ou não booleano",
+    "multiplayer_invalido": "multiplayer ausente ou não booleano",
+    "versao_ausente": "version ausente",
+    "dificuldade_ausente": "difficulty ausente",
+    "personagem_desconhecido": "ID de personagem fora de PERSONAGENS",
+    "dano_invalido": "Dano, dano em chefes ou DPS negativo/não numérico",
+    "upgrades_invalidos": "upgrade_indexes fora do formato esperado",
+}
+
+
+def _lista_de_inteiros(upgs):
+    try:
+        tipo = pa.array(upgs).type
+    except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+        return False
+    return pa.types.is_integer(tipo) or pa.types.is_null(tipo)
+
+
+def validar_upgrades(upgrades):
+    """Converte as listas de upgrades para Arrow e marca as inválidas.
+
+    Retorna (array list<int64>, máscara de válidos). Inválidas são as que
+    não são lista, têm valor não inteiro/nulo ou fora da faixa do int16.
+    """
+    tipo = pa.list_(pa.int64())
+    try:
+        arr = pa.array(upgrades)
+        tipo_ok = pa.types.is_null(arr.type) or (
+            pa.types.is_list(arr.type)
+            and (
+                pa.types.is_integer(arr.type.value_type)
+                or pa.types.is_null(arr.type.value_type)
+            )
+        )
+    except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+        tipo_ok = False
+    if tipo_ok:
+        arr = arr.cast(tipo)
+    else:
+        # Tipos misturados no lote: só então cada lista é verificada
+        arr = pa.array(
+            [u if u is not None and _lista_de_inteiros(u) else None for u in upgrades],
+            type=tipo,
+        )
+
+    valores = pc.list_flatten(arr)
+    fora_da_faixa = pc.fill_null(
+        pc.or_(pc.less(valores, -32768), pc.greater(valores, 32767)), True
+    ).to_numpy(zero_copy_only=False)
+    origem = pc.list_parent_indices(arr).to_numpy(zero_copy_only=False)
+    ruins = np.bincount(origem[fora_da_faixa], minlength=len(arr)) > 0
+    ruins |= arr.is_null().to_numpy(zero_copy_only=False)
+    return arr, ~ruins
+
+
+def validar_partidas(df, df_chars, linhas):
+    """Aplica REGRAS_VALIDACAO de forma vetorizada.
+
+    `linhas` é o índice em `df` de cada linha de `df_chars`. Retorna as
+    máscaras de partidas e personagens válidos e o frame de quarentena,
+    com uma coluna booleana por regra e os motivos em texto.
+    """
+    tempo = pd.to_numeric(df["total_seconds"], errors="coerce")
+    wave = pd.to_numeric(df["wave"], errors="coerce")
+    regras = pd.DataFrame(
+        {
+            "id_duplicado": df["id"].duplicated(),
+            "sem_personagens": df["characters_count"] == 0,
+            "tempo_invalido": ~(tempo > 0),
+            "wave_invalida": ~(wave >= 0),
+            "win_invalido": ~df["win"].isin([True, False]),
+            "multiplayer_invalido": ~df["multiplayer"].isin([True, False]),
+            "versao_ausente": df["version"].isna(),
+            "dificuldade_ausente": df["difficulty"].isna(),
+        },
+        index=df.index,
+    )
+
+    # Regras por personagem: uma linha ruim invalida a partida inteira
+    if df_chars.empty:
+        regras_chars = pd.DataFrame(
+            False,
+            index=df.index,
+            columns=["personagem_desconhecido", "dano_invalido", "upgrades_invalidos"],
+        )
+    else:
+        numericos = df_chars[["damage", "damage_boss", "dps"]].apply(
+            pd.to_numeric, errors="coerce"
+        )
+        regras_chars = (
+            pd.DataFrame(
+                {
+                    "personagem_desconhecido": ~pd.to_numeric(
+                        df_chars["character_id"], errors="coerce"
+                    ).isin([int(c) for c in PERSONAGENS]),
+                    "dano_invalido": ~(numericos >= 0).all(axis=1),
+                    "upgrades_invalidos": ~df_chars["upgrades_validos"],
+                }
+            )
+            .groupby(np.asarray(linhas))
+            .any()
+            .reindex(df.index, fill_value=False)
+        )
+    regras = regras.join(regras_chars)
+
+    partidas_ok = ~regras.any(axis=1)
+    chars_ok = partidas_ok.reindex(linhas).to_numpy(dtype=bool)
+
+    invalidas = regras[~partidas_ok]
+    quarentena = pd.concat([df[~partidas_ok], invalidas], axis=1)
+    quarentena["motivos"] = (
+        invalidas.dot(invalidas.columns + ", ").str.rstrip(", ")
+        if not invalidas.empty
+        else pd.Series(dtype=str)
+    )
+
+    return partidas_ok.to_numpy(dtype=bool), chars_ok, quarentena
+
+
+# ==========================
+# GRÁFICOS
+# ==========================
+# Teto de pontos por série enviados ao navegador
+MAX_PONTOS_GRAFICO = 2000
+
+
+@st.cache_data(ttl=300, max_entries=200)
+def figura_em_cache(chave, _construir):
+    """Monta a figura uma vez por chave (snapshot, filtros, gráfico).
+
+    `_construir` não entra no hash; tudo que muda o gráfico deve estar
+    na chave.
+    """
+    fig = _construir()
+    fig.update_layout(dragmode=False)
+    return fig.to_dict()
+
+
+def mostrar_grafico(chave, construir):
+    st.plotly_chart(
+        figura_em_cache(chave, construir),
+        width="stretch",
+        config={"displayModeBar": False},
+    )
+
+
+def lttb(x, y, n_pontos=MAX_PONTOS_GRAFICO):
+    """Índices dos pontos escolhidos pelo Largest-Triangle-Three-Buckets."""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    if n <= n_pontos or n_pontos < 3:
+        return np.arange(n)
+
+    tamanho = (n - 2) / (n_pontos - 2)
+    bordas = (np.arange(n_pontos - 1) * tamanho).astype(np.int64) + 1
+    bordas[-1] = n - 1
+    escolhidos = np.empty(n_pontos, dtype=np.int64)
+    escolhidos[0] = 0
+    escolhidos[-1] = n - 1
+    a = 0
+    for i in range(n_pontos - 2):
+        inicio, fim = bordas[i], bordas[i + 1]
+        prox_fim = bordas[i + 2] if i + 2 < len(bordas) else n
+        media_x = x[fim:prox_fim].mean()
+        media_y = y[fim:prox_fim].mean()
+        areas = np.abs(
+            (x[a] - media_x) * (y[inicio:fim] - y[a])
+            - (x[a] - x[inicio:fim]) * (media_y - y[a])
+        )
+        a = inicio + int(areas.argmax())
+        escolhidos[i + 1] = a
+    return escolhidos
+
+
+def reduzir_serie(df, x, y, n_pontos=MAX_PONTOS_GRAFICO):
+    """Aplica LTTB a uma série temporal já ordenada por `x`."""
+    valores_x = df[x]
+    if pd.api.types.is_datetime64_any_dtype(valores_x):
+        valores_x = valores_x.astype("int64")
+    return df.iloc[lttb(valores_x, df[y], n_pontos)]
+
+
+def binarizar(serie, n_bins=50):
+    """Histograma calculado no servidor: um ponto por faixa, não por linha."""
+    valores = pd.to_numeric(serie, errors="coerce").dropna().to_numpy()
+    if len(valores) == 0:
+        return pd.DataFrame(columns=["inicio", "fim", "centro", "quantidade"])
+    contagens, bordas = np.histogram(valores, bins=n_bins)
+    return pd.DataFrame(
+        {
+            "inicio": bordas[:-1],
+            "fim": bordas[1:],
+            "centro": (bordas[:-1] + bordas[1:]) / 2,
+            "quantidade": contagens,
+        }
+    )
+
+
+# ==========================
+# EXPORTAÇÃO
+# ==========================
+FORMATOS_EXPORTACAO = {
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+    "Arrow IPC": ("arrows", "application/vnd.apache.arrow.stream"),
+}
+LINHAS_POR_LOTE = 100_000
+# Linhas lidas para inferir o tipo Arrow de colunas object
+AMOSTRA_SCHEMA = 1_000
+# O download do Streamlit exige o arquivo inteiro em memória: acima disso
+# a exportação é bloqueada e o usuário precisa refinar os filtros
+MAX_LINHAS_EXPORTACAO = 1_000_000
+
+
+def _tem_struct(tipo):
+    if pa.types.is_struct(tipo) or pa.types.is_map(tipo):
+        return True
+    if pa.types.is_list(tipo) or pa.types.is_large_list(tipo):
+        return _tem_struct(tipo.value_type)
+    return False
+
+
+def schema_exportacao(df, colunas_json=()):
+    """Schema Arrow do frame; colunas object têm o tipo inferido de uma
+    amostra. Objetos JSON (dicts, listas de dicts) e valores que não
+    cabem num tipo Arrow único são exportados como texto."""
+    # Tipos com dtype definido saem do frame vazio
+    tipos = pa.Schema.from_pandas(df.head(0), preserve_index=False)
+    amostra = df.head(AMOSTRA_SCHEMA)
+    campos = []
+    colunas_json = list(colunas_json)
+    for coluna in df.columns:
+        tipo = tipos.field(str(coluna)).type
+        if coluna in colunas_json:
+            tipo = pa.string()
+        elif df[coluna].dtype == object:
+            try:
+                tipo = pa.array(amostra[coluna], from_pandas=True).type
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                tipo = pa.null()
+                colunas_json.append(coluna)
+            # Struct inferido da amostra descarta sem erro chaves que só
+            # aparecem depois; como texto nada se perde
+            if _tem_struct(tipo):
+                colunas_json.append(coluna)
+            if coluna in colunas_json or pa.types.is_null(tipo):
+                tipo = pa.string()
+        campos.append(pa.field(str(coluna), tipo))
+    return pa.schema(campos), colunas_json
+
+
+def _para_json(serie):
+    return serie.map(lambda v: None if v is None else json.dumps(v, default=str))
+
+
+def _escrever_lotes(df, writer, schema, colunas_json):
+    """Escreve os lotes; devolve as colunas que não couberam no schema."""
+    for inicio in range(0, len(df), LINHAS_POR_LOTE):
+        lote = df.iloc[inicio : inicio + LINHAS_POR_LOTE]
+        if colunas_json:
+            lote = lote.assign(**{c: _para_json(lote[c]) for c in colunas_json})
+        try:
+            batch = pa.RecordBatch.from_pandas(
+                lote, schema=schema, preserve_index=False
+            )
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # Só no erro: descobre qual coluna fugiu do tipo da amostra
+            incompativeis = []
+            for campo in schema:
+                if campo.name in colunas_json or lote[campo.name].dtype != object:
+                    continue
+                try:
+                    pa.array(lote[campo.name], type=campo.type, from_pandas=True)
+                except (pa.ArrowInvalid, pa.ArrowTypeError):
+                    incompativeis.append(campo.name)
+            if not incompativeis:
+                raise
+            return incompativeis
+        writer.write_batch(batch)
+    return []
+
+
+def exportar_arrow(df, formato):
+    """Escreve o frame em lotes de LINHAS_POR_LOTE, sem passar por CSV.
+
+    Retorna um pa.Buffer com o arquivo. Se um lote não couber no tipo
+    inferido da amostra, a exportação recomeça com a coluna como texto JSON.
+    """
+    colunas_json = []
+    while True:
+        schema, colunas_json = schema_exportacao(df, colunas_json)
+        destino = pa.BufferOutputStream()
+        if formato == "Parquet":
+            writer = pq.ParquetWriter(destino, schema)
+        else:
+            writer = pa.ipc.new_stream(destino, schema)
+        with writer:
+            incompativeis = _escrever_lotes(df, writer, schema, colunas_json)
+        if not incompativeis:
+            return destino.getvalue()
+        colunas_json += incompativeis
+
+
+# ==========================
+# SOBREVIVÊNCIA POR WAVE
+# ==========================
+# Granularidade do histograma: cobre todos os filtros da barra lateral e as
+# quebras do gráfico, então nada precisa reagrupar as partidas brutas
+WAVE_DIMENSOES = ["version", "multiplayer", "difficulty", "stage", "main_character"]
+
+
+def histograma_waves(df, df_chars):
+    """Conta partidas e derrotas por wave final em cada combinação de dimensões."""
+    mains = df_chars[df_chars["is_main"] == True] if not df_chars.empty else df_chars
+    main_por_partida = (
+        mains.set_index("partida_id")["character_id"].astype(str)
+        if not mains.empty
+        else pd.Series(dtype=str)
+    )
+    base = df[WAVE_DIMENSOES[:-1] + ["wave"]].assign(
+        main_character=df["id"].map(main_por_partida),
+        partidas=1,
+        derrotas=(df["win"] == False).astype(int),
+    )
+    return (
+        base.groupby(WAVE_DIMENSOES + ["wave"], dropna=False)[["partidas", "derrotas"]]
+        .sum()
+        .reset_index()
+    )
+
+
+def somar_histogramas(hist, novo):
+    """Soma dois histogramas de waves (ex.: acumulado + partidas novas)."""
+    return (
+        pd.concat([hist, novo], ignore_index=True)
+        .groupby(WAVE_DIMENSOES + ["wave"], dropna=False)[["partidas", "derrotas"]]
+        .sum()
+        .reset_index()
+    )
+
+
+@st.cache_resource
+def _histograma_acumulado():
+    """Histograma e maior ID já contados, compartilhados entre recargas."""
+    return {}
+
+
+def histograma_incremental(df, df_chars):
+    """Soma ao histograma acumulado só as partidas com ID acima do último
+    contado.
+
+    Se o total acumulado + novas não bater com o número de partidas
+    (partidas apagadas ou reclassificadas pela validação), recalcula tudo.
+    """
+    estado = _histograma_acumulado()
+    hist = estado.get("hist")
+    if hist is not None and not df.empty:
+        novas = df["id"] > estado["max_id"]
+        if hist["partidas"].sum() + novas.sum() == len(df):
+            chars_novas = (
+                df_chars[df_chars["partida_id"].isin(df.loc[novas, "id"])]
+                if not df_chars.empty
+                else df_chars
+            )
+            hist = somar_histogramas(hist, histograma_waves(df[novas], chars_novas))
+        else:
+            hist = None
+    if hist is None or df.empty:
+        hist = histograma_waves(df, df_chars)
+
+    estado["hist"] = hist
+    estado["max_id"] = df["id"].max() if not df.empty else None
+    return hist
+
+
+def curva_sobrevivencia(hist, por=None):
+    """Funil de waves a partir do histograma.
+
+    Para cada wave: partidas que a alcançaram, risco de derrota nela
+    (derrotas / alcançaram) e sobrevivência estilo Kaplan–Meier.
+    """
+    grupos = [por] if por else []
+    h = hist.groupby(grupos + ["wave"], dropna=False)[["partidas", "derrotas"]].sum()
+    if h.empty:
+        return pd.DataFrame(
+            columns=grupos
+            + [
+                "wave",
+                "partidas",
+                "derrotas",
+                "alcancaram",
+                "risco",
+                "sobrevivencia",
+                "alcancaram_pct",
+            ]
+        )
+
+    waves = hist["wave"].dropna()
+    todas_waves = np.arange(int(waves.min()), int(waves.max()) + 1)
+    if por:
+        indice = pd.MultiIndex.from_product(
+            [h.index.get_level_values(0).unique(), todas_waves], names=[por, "wave"]
+        )
+    else:
+        indice = pd.Index(todas_waves, name="wave")
+    h = h.reindex(indice, fill_value=0).reset_index()
 
-    return df, df_chars
+    # Quem terminou na wave w ou depois alcançou w: soma acumulada reversa
+    chave = h[por] if por else pd.Series(0, index=h.index)
+    h["alcancaram"] = h["partidas"][::-1].groupby(chave[::-1], dropna=False).cumsum()
+    h["risco"] = (h["derrotas"] / h["alcancaram"]).where(h["alcancaram"] > 0, 0.0)
+    h["sobrevivencia"] = (1 - h["risco"]).groupby(chave, dropna=False).cumprod()
+    h["alcancaram_pct"] = (
+        h["alcancaram"] / h.groupby(chave, dropna=False)["alcancaram"].transform("max")
+    ) * 100
+    return h
+
+
+# ==========================
+# ANÁLISE DE UPGRADES
+# ==========================
+def upgrade_arrays(upgrade_indexes):
+    """Devolve (offsets, valores) planos da coluna de listas de upgrades."""
+    arr = pa.array(upgrade_indexes, type=UPGRADES_TYPE)
+    if isinstance(arr, pa.ChunkedArray):
+        arr = arr.combine_chunks()
+    lengths = pc.list_value_length(arr).fill_null(0).to_numpy(zero_copy_only=False)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    values = pc.list_flatten(arr).to_numpy(zero_copy_only=False).astype(np.int16)
+    return offsets, values
+
+
+def calcular_upgrades(df_chars, tamanho_sequencia=3):
+    """Taxa de escolha e de vitória por upgrade e sequências mais comuns.
+
+    Tudo é calculado sobre o array plano de valores, sem iterar linhas.
+    As sequências saem como colunas u1..uN; o rótulo em texto fica para
+    quem exibe.
+    """
+    offsets, values = upgrade_arrays(df_chars["upgrade_indexes"])
+    lengths = np.diff(offsets)
+    # Fatoriza antes de virar texto: só os IDs distintos são convertidos
+    char_codigos, char_ids = pd.factorize(df_chars["character_id"])
+    char_ids = np.asarray(char_ids.astype(str), dtype=object)
+    wins = df_chars["win"].fillna(False).to_numpy(dtype=bool)
+
+    # Linha de origem de cada valor; (linha, upgrade) únicos para não contar
+    # duas vezes o mesmo upgrade pego repetido na mesma partida. Os códigos
+    # já vêm em ordem de linha, então o sort estável (timsort) só mescla
+    # trechos quase ordenados
+    linhas = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+    pares = np.sort(linhas * 65536 + (values.astype(np.int64) + 32768), kind="stable")
+    pares = pares[np.r_[True, pares[1:] != pares[:-1]]]
+    linhas_u = pares // 65536
+
+    # Contagem por (personagem, upgrade) com bincount num espaço denso
+    chave = char_codigos[linhas_u].astype(np.int64) * 65536 + pares % 65536
+    total_chaves = len(char_ids) * 65536
+    escolhas = np.bincount(chave, minlength=total_chaves)
+    vitorias = np.bincount(chave, weights=wins[linhas_u], minlength=total_chaves)
+    presentes = np.flatnonzero(escolhas)
+    stats = pd.DataFrame(
+        {
+            "character_id": char_ids[presentes // 65536],
+            "upgrade": (presentes % 65536 - 32768).astype(np.int16),
+            "escolhas": escolhas[presentes],
+            "vitorias": vitorias[presentes].astype(np.int64),
+        }
+    )
+    linhas_por_personagem = np.bincount(char_codigos, minlength=len(char_ids))
+    vitorias_por_personagem = np.bincount(
+        char_codigos, weights=wins, minlength=len(char_ids)
+    )
+    codigos_stats = presentes // 65536
+    stats["taxa_escolha"] = (
+        stats["escolhas"] / linhas_por_personagem[codigos_stats] * 100
+    )
+    stats["taxa_vitoria"] = stats["vitorias"] / stats["escolhas"] * 100
+    stats["taxa_vitoria_personagem"] = (
+        vitorias_por_personagem[codigos_stats]
+        / linhas_por_personagem[codigos_stats]
+        * 100
+    )
+
+    # Sequências: os primeiros N upgrades de cada personagem, lidos direto
+    # dos offsets com indexação vetorizada
+    mask = lengths >= tamanho_sequencia
+    idx = offsets[:-1][mask][:, None] + np.arange(tamanho_sequencia)
+    passos = [f"u{i + 1}" for i in range(tamanho_sequencia)]
+    seqs = pd.DataFrame(values[idx], columns=passos)
+    seqs["character_id"] = char_ids[char_codigos[mask]]
+    seqs["win"] = wins[mask]
+    sequencias = (
+        seqs.groupby(["character_id"] + passos)
+        .agg(quantidade=("win", "size"), taxa_vitoria=("win", "mean"))
+        .reset_index()
+        .sort_values("quantidade", ascending=False)
+    )
+    sequencias["taxa_vitoria"] = sequencias["taxa_vitoria"] * 100
+
+    return stats, sequencias
+
+
+@st.cache_data(ttl=300, max_entries=50)
+def upgrades_em_cache(chave, _df_chars):
+    """calcular_upgrades() uma vez por (snapshot, filtros, tipo de personagem)."""
+    return calcular_upgrades(_df_chars)
 
 
 # ==========================
@@ -184,7 +755,7 @@ def load_data():
 
 
 with st.spinner("Carregando dados do Supabase..."):
-    df_partidas, df_personagens = load_data()
+    df_partidas, df_personagens, hist_waves, quarentena = load_data()
 
 if df_partidas.empty:
     st.error("Nenhum dado encontrado.")
@@ -274,18 +845,34 @@ selected_stage = st.sidebar.selectbox(
     on_change=update_stage,
 )
 
-# Aplicar filtros
-df_f = df_partidas.copy()
-if selected_version != "Todas":
-    df_f = df_f[df_f["version"] == selected_version]
-if selected_mp == "Sim":
-    df_f = df_f[df_f["multiplayer"] == True]
-elif selected_mp == "Não":
-    df_f = df_f[df_f["multiplayer"] == False]
-if selected_diff != "Todas":
-    df_f = df_f[df_f["difficulty"] == selected_diff]
-if selected_stage != "Todos":
-    df_f = df_f[df_f["stage"] == selected_stage]
+
+# Aplicar filtros (partidas e histograma de waves compartilham as colunas)
+def aplicar_filtros(df):
+    if selected_version != "Todas":
+        df = df[df["version"] == selected_version]
+    if selected_mp == "Sim":
+        df = df[df["multiplayer"] == True]
+    elif selected_mp == "Não":
+        df = df[df["multiplayer"] == False]
+    if selected_diff != "Todas":
+        df = df[df["difficulty"] == selected_diff]
+    if selected_stage != "Todos":
+        df = df[df["stage"] == selected_stage]
+    return df
+
+
+df_f = aplicar_filtros(df_partidas.copy())
+hist_waves_f = aplicar_filtros(hist_waves)
+
+# Chave dos gráficos em cache: muda quando chegam dados novos ou os filtros mudam
+chave_filtros = (
+    len(df_partidas),
+    df_partidas["id"].max(),
+    selected_version,
+    selected_mp,
+    selected_diff,
+    selected_stage,
+)
 
 df_chars_f = df_personagens[df_personagens["partida_id"].isin(df_f["id"])]
 
@@ -298,12 +885,11 @@ st.title("📊 ShardSquad - Análise Direta do Supabase")
 # 1. Total de partidas
 total_partidas = len(df_f)
 
-# 2. Wave com mais derrotas
-derrotas = df_f[df_f["win"] == False]
+# 2. Wave com mais derrotas (direto do histograma de waves)
 wave_mais_derrotas = "–"
-if not derrotas.empty:
-    wave_counts = derrotas["wave"].value_counts()
-    wave_mais_derrotas = wave_counts.idxmax()
+derrotas_por_wave = hist_waves_f.groupby("wave")["derrotas"].sum()
+if derrotas_por_wave.sum() > 0:
+    wave_mais_derrotas = derrotas_por_wave.idxmax()
 
 # 3. Jogador com mais vitórias (usa steam_id para cálculo, mostra steam_name)
 jogador_mais_vitorias = "–"
@@ -333,24 +919,115 @@ st.divider()
 # ==========================
 # ABAS
 # ==========================
-tab1, tab2, tab3, tab4 = st.tabs(
-    ["📈 Visão Geral", "👥 Jogadores", "🎭 Personagens", "📄 Dados Brutos"]
+tab1, tab2, tab3, tab4, tab5 = st.tabs(
+    [
+        "📈 Visão Geral",
+        "👥 Jogadores",
+        "🎭 Personagens",
+        "📄 Dados Brutos",
+        "🧬 Upgrades",
+    ]
 )
 
 with tab1:
-    st.subheader("Wave com mais derrotas")
-    derrotas = df_f[df_f["win"] == False]
-    if not derrotas.empty:
-        fig = px.bar(
-            derrotas.groupby("wave").size().reset_index(name="count"),
-            x="wave",
-            y="count",
-            text="count",
-        )
-        fig.update_layout(dragmode=False)
-        st.plotly_chart(fig, width="stretch", config={"displayModeBar": False})
+    st.subheader("Funil de waves")
+    quebras = {
+        "Nenhuma": None,
+        "Dificuldade": "difficulty",
+        "Estágio": "stage",
+        "Personagem principal": "main_character",
+    }
+    quebra = st.selectbox("Dividir por", options=list(quebras), key="tab1_quebra")
+    curva = curva_sobrevivencia(hist_waves_f, quebras[quebra])
+
+    if curva.empty:
+        st.info("Nenhuma partida.")
     else:
-        st.info("Nenhuma derrota.")
+        cor = None
+        if quebras[quebra]:
+            cor = "grupo"
+            curva["grupo"] = curva[quebras[quebra]].astype(str)
+            if quebras[quebra] == "main_character":
+                curva["grupo"] = curva["grupo"].map(PERSONAGENS).fillna(curva["grupo"])
+
+        col_w1, col_w2 = st.columns(2)
+        with col_w1:
+            mostrar_grafico(
+                chave_filtros + ("sobrevivencia", quebra),
+                lambda: px.line(
+                    curva,
+                    x="wave",
+                    y="alcancaram_pct",
+                    color=cor,
+                    line_shape="hv",
+                    labels={
+                        "wave": "Wave",
+                        "alcancaram_pct": "Partidas que alcançaram (%)",
+                        "grupo": quebra,
+                    },
+                    hover_data=["alcancaram", "sobrevivencia"],
+                    title="Sobrevivência por wave",
+                ),
+            )
+        with col_w2:
+            mostrar_grafico(
+                chave_filtros + ("risco", quebra),
+                lambda: px.line(
+                    curva,
+                    x="wave",
+                    y="risco",
+                    color=cor,
+                    markers=True,
+                    labels={
+                        "wave": "Wave",
+                        "risco": "Risco de derrota na wave",
+                        "grupo": quebra,
+                    },
+                    hover_data=["derrotas", "alcancaram"],
+                    title="Risco de derrota por wave",
+                ).update_layout(yaxis_tickformat=".0%"),
+            )
+
+    st.divider()
+    col_t1, col_t2 = st.columns(2)
+    with col_t1:
+        st.subheader("Duração das partidas")
+        if df_f.empty:
+            st.info("Nenhuma partida.")
+        else:
+            # Agrupado em faixas no servidor: o navegador recebe só os bins
+            mostrar_grafico(
+                chave_filtros + ("duracao",),
+                lambda: px.bar(
+                    binarizar(df_f["total_seconds"] / 60),
+                    x="centro",
+                    y="quantidade",
+                    hover_data=["inicio", "fim"],
+                    labels={"centro": "Minutos", "quantidade": "Partidas"},
+                ).update_layout(bargap=0),
+            )
+    with col_t2:
+        st.subheader("Partidas ao longo do tempo")
+        partidas_tempo = df_f[["start_time_dt"]].dropna().sort_values("start_time_dt")
+        if partidas_tempo.empty:
+            st.info("Nenhuma partida com data de início.")
+        else:
+            # Uma linha por partida vira no máximo MAX_PONTOS_GRAFICO pontos
+            def construir_tempo():
+                serie = partidas_tempo.assign(
+                    partidas=np.arange(1, len(partidas_tempo) + 1)
+                )
+                return px.line(
+                    reduzir_serie(serie, "start_time_dt", "partidas"),
+                    x="start_time_dt",
+                    y="partidas",
+                    labels={
+                        "start_time_dt": "Início",
+                        "partidas": "Partidas (acumulado)",
+                    },
+                )
+
+            mostrar_grafico(chave_filtros + ("tempo",), construir_tempo)
 
 with tab2:
     # Calcula estatísticas por jogador
@@ -370,27 +1047,27 @@ with tab2:
         st.info("Nenhum dado de jogador.")
     else:
         # Preparar para gráfico empilhado
-        fig = px.bar(
-            jogadores_stats,
-            y="steam_name",
-            x=["vitorias", "derrotas"],
-            orientation="h",
-            labels={"value": "Partidas", "steam_name": "Jogador"},
-            color_discrete_sequence=[
-                "#2E568B",
-                "#FF2323",
-            ],  # verde escuro, vermelho claro
-            barmode="stack",
-        )
-        fig.update_layout(
-            dragmode=False,
-            yaxis={"categoryorder": "total ascending"},
-            legend_title_text="Resultado",
-            xaxis_title="Partidas",
-            yaxis_title="Jogador",
-        )
         st.subheader("Desempenho por Jogador (Vitórias vs Derrotas)")
-        st.plotly_chart(fig, use_container_width=True, config={"displayModeBar": False})
+        mostrar_grafico(
+            chave_filtros + ("jogadores",),
+            lambda: px.bar(
+                jogadores_stats,
+                y="steam_name",
+                x=["vitorias", "derrotas"],
+                orientation="h",
+                labels={"value": "Partidas", "steam_name": "Jogador"},
+                color_discrete_sequence=[
+                    "#2E568B",
+                    "#FF2323",
+                ],  # verde escuro, vermelho claro
+                barmode="stack",
+            ).update_layout(
+                yaxis={"categoryorder": "total ascending"},
+                legend_title_text="Resultado",
+                xaxis_title="Partidas",
+                yaxis_title="Jogador",
+            ),
+        )
 
 # --------------------------
 # TAB 3: Personagens
@@ -768,6 +1445,218 @@ with tab4:
         },
     )
 
+    # === Qualidade dos dados ===
+    with st.expander(
+        f"🧪 Partidas em quarentena: {len(quarentena):,}".replace(",", ".")
+    ):
+        if quarentena.empty:
+            st.success("Nenhuma partida descartada pela validação.")
+        else:
+            contagem_regras = (
+                quarentena[list(REGRAS_VALIDACAO)]
+                .sum()
+                .rename("partidas")
+                .rename_axis("regra")
+                .reset_index()
+            )
+            contagem_regras["descricao"] = contagem_regras["regra"].map(
+                REGRAS_VALIDACAO
+            )
+            st.dataframe(
+                contagem_regras[["regra", "descricao", "partidas"]],
+                hide_index=True,
+                width="stretch",
+                column_config={
+                    "regra": st.column_config.TextColumn("Regra"),
+                    "descricao": st.column_config.TextColumn("Descrição"),
+                    "partidas": st.column_config.NumberColumn(
+                        "Partidas", format="localized"
+                    ),
+                },
+            )
+            st.dataframe(
+                quarentena[
+                    ["id", "steam_name", "version", "total_seconds", "wave", "motivos"]
+                ],
+                hide_index=True,
+                width="stretch",
+                height=300,
+                column_config={
+                    "motivos": st.column_config.TextColumn(
+                        "Motivos", help="Regras de validação que falharam"
+                    ),
+                },
+            )
+
+
+# --------------------------
+# TAB 5: Upgrades
+# --------------------------
+with tab5:
+    if df_chars_f.empty:
+        st.info("Nenhum dado de personagem nos filtros atuais.")
+    else:
+        col_u1, col_u2 = st.columns(2)
+        with col_u1:
+            tipo_upgrade = st.selectbox(
+                "Personagens",
+                options=["Todos", "Principais", "Secundários"],
+                key="tab5_tipo",
+            )
+        df_upg = df_chars_f
+        if tipo_upgrade == "Principais":
+            df_upg = df_upg[df_upg["is_main"] == True]
+        elif tipo_upgrade == "Secundários":
+            df_upg = df_upg[df_upg["is_main"] == False]
+
+        stats_upg, sequencias_upg = upgrades_em_cache(
+            chave_filtros + (tipo_upgrade,), df_upg
+        )
+
+        ids_upg = sorted(df_upg["character_id"].astype(str).unique())
+        with col_u2:
+            personagem_upg = st.selectbox(
+                "Personagem",
+                options=ids_upg,
+                format_func=lambda c: PERSONAGENS.get(c, c),
+                key="tab5_personagem",
+            )
+
+        stats_p = stats_upg[stats_upg["character_id"] == personagem_upg]
+        seqs_p = sequencias_upg[sequencias_upg["character_id"] == personagem_upg]
+
+        if stats_p.empty:
+            st.info("Nenhum upgrade registrado para este personagem.")
+        else:
+            st.subheader(
+                f"Upgrades de {PERSONAGENS.get(personagem_upg, personagem_upg)}"
+            )
+            stats_p = stats_p.sort_values("taxa_escolha", ascending=False)
+            mostrar_grafico(
+                chave_filtros + ("upgrades", tipo_upgrade, personagem_upg),
+                lambda: px.bar(
+                    stats_p,
+                    x=stats_p["upgrade"].astype(str),
+                    y="taxa_escolha",
+                    color="taxa_vitoria",
+                    color_continuous_scale="RdBu",
+                    labels={
+                        "x": "Upgrade",
+                        "taxa_escolha": "Taxa de escolha (%)",
+                        "taxa_vitoria": "Vitórias (%)",
+                    },
+                ).update_layout(xaxis_type="category"),
+            )
+
+            st.dataframe(
+                stats_p[
+                    [
+                        "upgrade",
+                        "escolhas",
+                        "taxa_escolha",
+                        "taxa_vitoria",
+                        "taxa_vitoria_personagem",
+                    ]
+                ].round(2),
+                hide_index=True,
+                width="stretch",
+                height=400,
+                column_config={
+                    "upgrade": st.column_config.TextColumn("Upgrade"),
+                    "escolhas": st.column_config.NumberColumn(
+                        "Escolhas", format="localized"
+                    ),
+                    "taxa_escolha": st.column_config.NumberColumn(
+                        "Taxa de Escolha (%)",
+                        format="localized",
+                        help="Partidas do personagem em que o upgrade foi pego",
+                    ),
+                    "taxa_vitoria": st.column_config.NumberColumn(
+                        "Vitórias com Upgrade (%)",
+                        format="localized",
+                        help="Taxa de vitória nas partidas em que o upgrade foi pego",
+                    ),
+                    "taxa_vitoria_personagem": st.column_config.NumberColumn(
+                        "Vitórias do Personagem (%)",
+                        format="localized",
+                        help="Taxa de vitória geral do personagem, para comparação",
+                    ),
+                },
+            )
+
+        st.subheader("Sequências mais comuns (3 primeiros upgrades)")
+        if seqs_p.empty:
+            st.info("Nenhuma sequência com 3 ou mais upgrades.")
+        else:
+            # Rótulo em texto só para as linhas exibidas
+            top_seqs = seqs_p.head(20).copy()
+            top_seqs["sequencia"] = (
+                top_seqs.filter(regex=r"^u\d+$").astype(str).agg(" → ".join, axis=1)
+            )
+            st.dataframe(
+                top_seqs[["sequencia", "quantidade", "taxa_vitoria"]].round(2),
+                hide_index=True,
+                width="stretch",
+                column_config={
+                    "sequencia": st.column_config.TextColumn("Sequência"),
+                    "quantidade": st.column_config.NumberColumn(
+                        "Quantidade", format="localized"
+                    ),
+                    "taxa_vitoria": st.column_config.NumberColumn(
+                        "Vitórias (%)", format="localized"
+                    ),
+                },
+            )
+
+
+# ==========================
+# EXPORTAR DADOS
+# ==========================
+with st.sidebar:
+    st.divider()
+    st.header("📥 Exportar")
+    conjuntos_exportacao = {
+        "Partidas (filtros)": (df_f, "partidas"),
+        "Personagens (filtros)": (df_chars_f, "personagens"),
+        "Dados Brutos (seleção)": (df_filtrado_tab4, "dados_brutos"),
+    }
+    conjunto = st.selectbox(
+        "Dados", options=list(conjuntos_exportacao), key="export_conjunto"
+    )
+    formato = st.selectbox(
+        "Formato", options=list(FORMATOS_EXPORTACAO), key="export_formato"
+    )
+    df_export, nome_export = conjuntos_exportacao[conjunto]
+    extensao, mime = FORMATOS_EXPORTACAO[formato]
+
+    grande_demais = len(df_export) > MAX_LINHAS_EXPORTACAO
+    if grande_demais:
+        st.warning(
+            f"Mais de {MAX_LINHAS_EXPORTACAO:,} linhas: refine os filtros para "
+            "exportar.".replace(",", ".")
+        )
+    else:
+        st.caption("O arquivo é montado em memória antes do download.")
+
+    # Só gera o arquivo quando pedido, não a cada rerun
+    if st.button(
+        f"Gerar arquivo ({len(df_export):,} linhas)".replace(",", "."),
+        key="export_gerar",
+        disabled=df_export.empty or grande_demais,
+    ):
+        # download_button só aceita bytes: uma cópia, e o buffer Arrow é
+        # liberado logo em seguida
+        with st.spinner("Gerando arquivo..."):
+            dados_export = exportar_arrow(df_export, formato).to_pybytes()
+        st.download_button(
+            "Baixar",
+            data=dados_export,
+            file_name=f"shardsquad_{nome_export}.{extensao}",
+            mime=mime,
+            on_click="ignore",
+            key="export_baixar",
+        )
+
 
 st.divider()
 st.caption("Dados carregados diretamente do Supabase • Atualizado a cada 5 minutos")
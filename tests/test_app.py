@@ -0,0 +1,416 @@
+import ast
+import json
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+APP = str(Path(__file__).resolve().parent.parent / "app.py")
+
+
+@pytest.fixture(scope="module")
+def app():
+    """Só imports, funções e CONSTANTES do app.py, sem rodar a interface."""
+    arvore = ast.parse(Path(APP).read_text(encoding="utf-8"))
+    nos = [
+        no
+        for no in arvore.body
+        if isinstance(no, (ast.Import, ast.ImportFrom, ast.FunctionDef))
+        or (
+            isinstance(no, ast.Assign)
+            and all(isinstance(t, ast.Name) and t.id.isupper() for t in no.targets)
+        )
+    ]
+    ns = {}
+    exec(compile(ast.Module(nos, type_ignores=[]), APP, "exec"), ns)
+    return SimpleNamespace(**ns)
+
+
+def partidas(n):
+    """Partidas válidas que passam nos filtros padrão da barra lateral."""
+    return pd.DataFrame(
+        [
+            {
+                "id": i,
+                "version": "1.0",
+                "steam_name": f"jogador{i % 7}",
+                "steam_id": str(i % 7),
+                "win": i % 3 == 0,
+                "wave": 1 + i % 10,
+                "stage": "s1",
+                "difficulty": 1,
+                "total_seconds": 100 + i,
+                "coins": 1,
+                "critical_hit_quantity": 1,
+                "multiplayer": False,
+                "characters_damage_data": [
+                    {
+                        "character": i % 22,
+                        "damage": 10,
+                        "damage_boss": 1,
+                        "dps": 2,
+                        "upgrade_indexes": [1, 2, 3],
+                    },
+                    {
+                        "character": (i + 1) % 22,
+                        "damage": 5,
+                        "damage_boss": 0,
+                        "dps": 1,
+                        "upgrade_indexes": [4],
+                    },
+                ],
+                "relics_id": [1],
+                "selected_rewards": [2],
+                "start_time": f"2025-01-01T00:{i % 60:02d}:00",
+            }
+            for i in range(n, 0, -1)
+        ]
+    )
+
+
+def rodar_app(df):
+    st.cache_data.clear()
+    st.cache_resource.clear()
+    with mock.patch("pandas.read_sql", return_value=df):
+        at = AppTest.from_file(APP, default_timeout=120)
+        at.session_state["authenticated"] = True
+        at.run()
+    assert not at.exception
+    return at
+
+
+def metrica(at, rotulo):
+    return next(m.value for m in at.metric if m.label == rotulo)
+
+
+def quarentena(at):
+    return next(e.label for e in at.expander if "quarentena" in e.label)
+
+
+@pytest.mark.parametrize(
+    "corromper",
+    [
+        lambda char: char.pop("character"),
+        lambda char: char.pop("dps"),
+        lambda char: char.update(upgrade_indexes=[1, True]),
+        lambda char: char.update(upgrade_indexes=[70000]),
+    ],
+    ids=["sem_character", "sem_dps", "upgrade_bool", "upgrade_fora_int16"],
+)
+def test_personagem_invalido_so_afeta_a_propria_partida(corromper):
+    df = partidas(300)
+    corromper(df.at[5, "characters_damage_data"][1])
+
+    at = rodar_app(df)
+
+    assert metrica(at, "🎮 Partidas") == "299"
+    assert quarentena(at) == "🧪 Partidas em quarentena: 1"
+
+
+def test_elemento_que_nao_e_dict_so_afeta_a_propria_partida():
+    df = partidas(300)
+    df.at[7, "characters_damage_data"].append("lixo")
+
+    at = rodar_app(df)
+
+    assert metrica(at, "🎮 Partidas") == "299"
+    assert quarentena(at) == "🧪 Partidas em quarentena: 1"
+
+
+@pytest.mark.parametrize("coluna", ["win", "multiplayer", "version", "difficulty"])
+def test_coluna_nula_so_afeta_a_propria_partida(coluna):
+    df = partidas(300)
+    df[coluna] = df[coluna].astype(object)
+    df.at[5, coluna] = None
+
+    at = rodar_app(df)
+
+    assert metrica(at, "🎮 Partidas") == "299"
+    assert quarentena(at) == "🧪 Partidas em quarentena: 1"
+
+
+def test_win_nao_booleano_vai_para_quarentena():
+    df = partidas(300)
+    df["win"] = df["win"].astype(object)
+    df.at[5, "win"] = "sim"
+
+    at = rodar_app(df)
+
+    assert quarentena(at) == "🧪 Partidas em quarentena: 1"
+
+
+def test_dificuldade_float_por_causa_de_null_mantem_rotulo_inteiro():
+    # NULL numa coluna inteira chega do banco como float64 (1.0)
+    df = partidas(300)
+    df["difficulty"] = df["difficulty"].astype(float)
+    df.at[5, "difficulty"] = np.nan
+
+    at = rodar_app(df)
+
+    assert metrica(at, "🎮 Partidas") == "299"
+    assert quarentena(at) == "🧪 Partidas em quarentena: 1"
+
+
+@pytest.mark.parametrize("formato", ["Parquet", "Arrow IPC"])
+@pytest.mark.parametrize(
+    "conjunto",
+    ["Partidas (filtros)", "Personagens (filtros)", "Dados Brutos (seleção)"],
+)
+def test_exportacao_gera_download(conjunto, formato):
+    df = partidas(50)
+    at = rodar_app(df)
+    at.selectbox(key="export_conjunto").set_value(conjunto)
+    at.selectbox(key="export_formato").set_value(formato)
+    at.button(key="export_gerar").click()
+    with mock.patch("pandas.read_sql", return_value=df):
+        at.run()
+
+    assert not at.exception
+    assert len(at.get("download_button")) == 1
+
+
+def personagens_com_upgrades(app, character_id, win, upgrades):
+    df = pd.DataFrame({"character_id": character_id, "win": win})
+    df["upgrade_indexes"] = pd.Series(
+        pa.array(upgrades, type=app.UPGRADES_TYPE),
+        dtype=pd.ArrowDtype(app.UPGRADES_TYPE),
+    )
+    return df
+
+
+def test_calcular_upgrades_conta_upgrade_repetido_uma_vez(app):
+    df = personagens_com_upgrades(
+        app,
+        character_id=[1, 1, 2],
+        win=[True, False, True],
+        upgrades=[[7, 7, 7], [7, 8], [9]],
+    )
+
+    stats, _ = app.calcular_upgrades(df)
+    stats = stats.set_index(["character_id", "upgrade"])
+
+    assert stats.loc[("1", 7), "escolhas"] == 2
+    assert stats.loc[("1", 7), "vitorias"] == 1
+    assert stats.loc[("1", 7), "taxa_escolha"] == 100
+    assert stats.loc[("1", 7), "taxa_vitoria"] == 50
+    assert stats.loc[("1", 8), "taxa_escolha"] == 50
+    assert stats.loc[("1", 8), "taxa_vitoria_personagem"] == 50
+    assert stats.loc[("2", 9), "escolhas"] == 1
+
+
+def test_calcular_upgrades_sequencias_usam_os_primeiros_upgrades(app):
+    df = personagens_com_upgrades(
+        app,
+        character_id=[1, 1, 1, 2],
+        win=[True, False, True, True],
+        upgrades=[[3, 1, 2, 9], [3, 1, 2], [3, 1], [5, 5, 5]],
+    )
+
+    _, sequencias = app.calcular_upgrades(df)
+
+    assert sequencias[["character_id", "u1", "u2", "u3", "quantidade"]].to_dict(
+        "records"
+    ) == [
+        {"character_id": "1", "u1": 3, "u2": 1, "u3": 2, "quantidade": 2},
+        {"character_id": "2", "u1": 5, "u2": 5, "u3": 5, "quantidade": 1},
+    ]
+    assert sequencias["taxa_vitoria"].tolist() == [50, 100]
+
+
+def histograma(app, linhas):
+    """Histograma à mão: (stage, wave, partidas, derrotas) por linha."""
+    hist = pd.DataFrame(linhas, columns=["stage", "wave", "partidas", "derrotas"])
+    return hist.assign(
+        version="1.0", multiplayer=False, difficulty="1", main_character="0"
+    )[app.WAVE_DIMENSOES + ["wave", "partidas", "derrotas"]]
+
+
+def test_curva_sobrevivencia_total(app):
+    hist = histograma(
+        app,
+        [("a", 1, 1, 1), ("a", 2, 1, 1), ("a", 4, 2, 1), (np.nan, 3, 1, 1)],
+    )
+
+    curva = app.curva_sobrevivencia(hist)
+
+    assert curva["wave"].tolist() == [1, 2, 3, 4]
+    assert curva["alcancaram"].tolist() == [5, 4, 3, 2]
+    np.testing.assert_allclose(curva["risco"], [1 / 5, 1 / 4, 1 / 3, 1 / 2])
+    np.testing.assert_allclose(curva["sobrevivencia"], [0.8, 0.6, 0.4, 0.2])
+    np.testing.assert_allclose(curva["alcancaram_pct"], [100, 80, 60, 40])
+
+
+def test_curva_sobrevivencia_por_grupo_com_nan(app):
+    hist = histograma(
+        app,
+        [("a", 1, 1, 1), ("a", 2, 1, 1), ("a", 4, 2, 1), (np.nan, 3, 1, 1)],
+    )
+
+    curva = app.curva_sobrevivencia(hist, "stage")
+    grupo_a = curva[curva["stage"] == "a"]
+    grupo_nan = curva[curva["stage"].isna()]
+
+    assert grupo_a["alcancaram"].tolist() == [4, 3, 2, 2]
+    np.testing.assert_allclose(grupo_a["risco"], [1 / 4, 1 / 3, 0, 1 / 2])
+    assert grupo_nan["alcancaram"].tolist() == [1, 1, 1, 0]
+    np.testing.assert_allclose(grupo_nan["risco"], [0, 0, 1, 0])
+    np.testing.assert_allclose(grupo_nan["sobrevivencia"], [1, 1, 0, 0])
+
+
+def partidas_com_mains(df):
+    df = df.assign(difficulty=df["difficulty"].astype(str))
+    df_chars = pd.DataFrame(
+        {"partida_id": df["id"], "character_id": df["id"] % 22, "is_main": True}
+    )
+    return df, df_chars
+
+
+def ordenar(hist):
+    return hist.sort_values(list(hist.columns)).reset_index(drop=True)
+
+
+def test_somar_histogramas_de_partes_igual_ao_todo(app):
+    df, df_chars = partidas_com_mains(partidas(40))
+    df.loc[df.index[::5], "stage"] = np.nan
+    metade = df["id"] > 20
+
+    soma = app.somar_histogramas(
+        app.histograma_waves(df[metade], df_chars[df_chars["partida_id"] > 20]),
+        app.histograma_waves(df[~metade], df_chars[df_chars["partida_id"] <= 20]),
+    )
+
+    pd.testing.assert_frame_equal(
+        ordenar(soma), ordenar(app.histograma_waves(df, df_chars))
+    )
+
+
+def test_histograma_incremental_soma_so_partidas_novas(app):
+    st.cache_resource.clear()
+    df, df_chars = partidas_com_mains(partidas(40))
+    antigas = df["id"] <= 30
+    app.histograma_incremental(df[antigas], df_chars)
+
+    # Partida já contada não é relida: a mudança não aparece no resultado
+    alterado = df.copy()
+    alterado.loc[alterado["id"] == 3, "win"] = not df.loc[df["id"] == 3, "win"].item()
+    hist = app.histograma_incremental(alterado, df_chars)
+
+    pd.testing.assert_frame_equal(
+        ordenar(hist), ordenar(app.histograma_waves(df, df_chars))
+    )
+
+
+def test_histograma_incremental_recalcula_quando_partidas_somem(app):
+    st.cache_resource.clear()
+    df, df_chars = partidas_com_mains(partidas(40))
+
+    app.histograma_incremental(df, df_chars)
+    restantes = df[df["id"] != 3]
+    hist = app.histograma_incremental(restantes, df_chars)
+
+    assert hist["partidas"].sum() == 39
+    pd.testing.assert_frame_equal(
+        ordenar(hist), ordenar(app.histograma_waves(restantes, df_chars))
+    )
+
+
+def test_lttb_mantem_extremos_e_quantidade(app):
+    x = np.arange(10_000)
+    y = np.sin(x / 100)
+
+    indices = app.lttb(x, y, 500)
+
+    assert len(indices) == 500
+    assert indices[0] == 0
+    assert indices[-1] == len(x) - 1
+    assert (np.diff(indices) > 0).all()
+
+
+def test_lttb_preserva_pico(app):
+    y = np.zeros(1_000)
+    y[637] = 50
+
+    assert 637 in app.lttb(np.arange(1_000), y, 50)
+
+
+@pytest.mark.parametrize("n", [0, 1, 5, 10])
+def test_lttb_devolve_tudo_quando_cabe(app, n):
+    indices = app.lttb(np.arange(n), np.arange(n), 10)
+
+    assert indices.tolist() == list(range(n))
+
+
+def test_binarizar_serie_vazia(app):
+    bins = app.binarizar(pd.Series([], dtype=float))
+
+    assert bins.empty
+    assert list(bins.columns) == ["inicio", "fim", "centro", "quantidade"]
+
+
+def test_binarizar_conta_e_ignora_nulos(app):
+    bins = app.binarizar(pd.Series([0, 1, 1, 4, None]), n_bins=4)
+
+    assert bins["quantidade"].tolist() == [1, 2, 0, 1]
+    assert bins["inicio"].tolist() == [0, 1, 2, 3]
+    assert bins["centro"].tolist() == [0.5, 1.5, 2.5, 3.5]
+
+
+def ler_exportacao(buffer, formato):
+    if formato == "Parquet":
+        return pq.read_table(pa.BufferReader(buffer))
+    return pa.ipc.open_stream(buffer).read_all()
+
+
+@pytest.mark.parametrize("formato", ["Parquet", "Arrow IPC"])
+def test_exportacao_nao_perde_chave_fora_da_amostra(app, monkeypatch, formato):
+    monkeypatch.setitem(app.exportar_arrow.__globals__, "AMOSTRA_SCHEMA", 2)
+    monkeypatch.setitem(app.exportar_arrow.__globals__, "LINHAS_POR_LOTE", 2)
+    df = pd.DataFrame(
+        {
+            "id": [1, 2, 3, 4],
+            "chars": [
+                [{"character": 0, "damage": 1}],
+                [{"character": 1, "damage": 2}],
+                [{"character": 1, "damage": 3}],
+                [{"character": 2, "damage": 5, "new_field": 99}],
+            ],
+        }
+    )
+
+    tabela = ler_exportacao(app.exportar_arrow(df, formato), formato)
+
+    assert json.loads(tabela.column("chars")[3].as_py()) == [
+        {"character": 2, "damage": 5, "new_field": 99}
+    ]
+    assert tabela.column("id").to_pylist() == [1, 2, 3, 4]
+
+
+def test_exportacao_acima_do_limite_fica_bloqueada():
+    df = partidas(50)
+    fonte = Path(APP).read_text(encoding="utf-8")
+    assert "MAX_LINHAS_EXPORTACAO = 1_000_000" in fonte
+    fonte = fonte.replace(
+        "MAX_LINHAS_EXPORTACAO = 1_000_000", "MAX_LINHAS_EXPORTACAO = 60"
+    )
+    st.cache_data.clear()
+    st.cache_resource.clear()
+    with mock.patch("pandas.read_sql", return_value=df):
+        at = AppTest.from_string(fonte, default_timeout=120)
+        at.session_state["authenticated"] = True
+        at.run()
+        assert not at.button(key="export_gerar").disabled
+
+        # 50 partidas x 2 personagens = 100 linhas, acima do limite de 60
+        at.selectbox(key="export_conjunto").set_value("Personagens (filtros)")
+        at.run()
+
+    assert not at.exception
+    assert at.button(key="export_gerar").disabled
+    assert any("refine os filtros" in w.value for w in at.warning)